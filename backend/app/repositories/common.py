@@ -1,5 +1,9 @@
 import json
 import os
+import threading
+from datetime import datetime, timedelta, timezone
+from functools import cache
+from typing import Any
 
 import boto3
 
@@ -9,6 +13,9 @@ ACCOUNT = os.environ.get("ACCOUNT", "")
 REGION = os.environ.get("REGION", "ap-northeast-1")
 TABLE_ACCESS_ROLE_ARN = os.environ.get("TABLE_ACCESS_ROLE_ARN", "")
 TRANSACTION_BATCH_SIZE = 25
+# Clients of assumed-role sessions are reused until the credentials are about to expire
+SESSION_CACHE_MAX_SIZE = 10_000
+SESSION_EXPIRY_MARGIN = timedelta(minutes=5)
 
 
 class RecordNotFoundError(Exception):
@@ -50,22 +57,35 @@ def decompose_bot_alias_id(composed_alias_id: str):
     return composed_alias_id.split("#")[-1]
 
 
-def _get_aws_resource(service_name, user_id=None):
-    """Get AWS resource with optional row-level access control for DynamoDB.
-    Ref: https://docs.aws.amazon.com/IAM/latest/UserGuide/reference_policies_examples_dynamodb_items.html
-    """
+def _get_endpoint_url():
     if "AWS_EXECUTION_ENV" not in os.environ:
-        if DDB_ENDPOINT_URL:
-            return boto3.resource(
-                service_name,
-                endpoint_url=DDB_ENDPOINT_URL,
-                aws_access_key_id="key",
-                aws_secret_access_key="key",
-                region_name=REGION,
-            )
-        else:
-            return boto3.resource(service_name, region_name=REGION)
+        return DDB_ENDPOINT_URL
+    return None
+
+
+@cache
+def _get_local_session():
+    # NOTE: Reuse the session since creating one loads the service models again
+    if DDB_ENDPOINT_URL:
+        return boto3.Session(
+            aws_access_key_id="key",
+            aws_secret_access_key="key",
+            region_name=REGION,
+        )
+    else:
+        return boto3.Session(region_name=REGION)
+
+
+@cache
+def _get_sts_client():
+    return boto3.client("sts")
 
+
+def _get_aws_session(user_id=None):
+    """Get AWS session with optional row-level access control for DynamoDB.
+    Returns the session and the expiration of its credentials.
+    Ref: https://docs.aws.amazon.com/IAM/latest/UserGuide/reference_policies_examples_dynamodb_items.html
+    """
     policy_document = {
         "Statement": [
             {
@@ -96,8 +116,7 @@ def _get_aws_resource(service_name, user_id=None):
             "ForAllValues:StringLike": {"dynamodb:LeadingKeys": [f"{user_id}*"]}
         }
 
-    sts_client = boto3.client("sts")
-    assumed_role_object = sts_client.assume_role(
+    assumed_role_object = _get_sts_client().assume_role(
         RoleArn=TABLE_ACCESS_ROLE_ARN,
         RoleSessionName="DynamoDBSession",
         Policy=json.dumps(policy_document),
@@ -107,22 +126,80 @@ def _get_aws_resource(service_name, user_id=None):
         aws_access_key_id=credentials["AccessKeyId"],
         aws_secret_access_key=credentials["SecretAccessKey"],
         aws_session_token=credentials["SessionToken"],
+        region_name=REGION,
     )
-    return session.resource(service_name, region_name=REGION)
+    return session, credentials["Expiration"]
+
+
+def _create_dynamodb_clients(session):
+    endpoint_url = _get_endpoint_url()
+    client = session.client("dynamodb", endpoint_url=endpoint_url)
+    table = session.resource("dynamodb", endpoint_url=endpoint_url).Table(TABLE_NAME)
+    return client, table
+
+
+# NOTE: boto3 sessions are not thread-safe, so the shared local session must not
+# be used by multiple threads at once to create clients.
+_local_clients_lock = threading.Lock()
+
+
+@cache
+def _get_local_dynamodb_clients():
+    return _create_dynamodb_clients(_get_local_session())
+
+
+# NOTE: Clients are cached per user until their credentials are about to expire,
+# so that the role is not assumed and clients are not created on every call.
+# Low-level clients are thread-safe, and the table resource is used only for
+# item operations, which are delegated to its low-level client.
+_clients_cache: dict[str | None, tuple[Any, Any, datetime]] = {}
+_clients_cache_lock = threading.Lock()
+
+
+def _get_dynamodb_clients(user_id=None):
+    """Get a low-level DynamoDB client and a table resource, optionally with
+    row-level access control.
+    """
+    if "AWS_EXECUTION_ENV" not in os.environ:
+        with _local_clients_lock:
+            return _get_local_dynamodb_clients()
+
+    cached = _clients_cache.get(user_id)
+    if cached:
+        client, table, expiration = cached
+        if datetime.now(timezone.utc) < expiration - SESSION_EXPIRY_MARGIN:
+            return client, table
+
+    # NOTE: The new session is not shared until cached, so no lock is needed
+    session, expiration = _get_aws_session(user_id=user_id)
+    client, table = _create_dynamodb_clients(session)
+    with _clients_cache_lock:
+        _clients_cache.pop(user_id, None)
+        if len(_clients_cache) >= SESSION_CACHE_MAX_SIZE:
+            # Evict the least recently created clients
+            _clients_cache.pop(next(iter(_clients_cache)))
+        _clients_cache[user_id] = (client, table, expiration)
+    return client, table
 
 
 def _get_dynamodb_client(user_id=None):
-    """Get a DynamoDB client, optionally with row-level access control."""
-    return _get_aws_resource("dynamodb", user_id=user_id).meta.client
+    """Get a low-level DynamoDB client, optionally with row-level access control.
+    NOTE: Unlike `resource.meta.client`, attribute values are not (de)serialized
+    automatically and must be given in DynamoDB JSON (e.g. `{"S": "value"}`).
+    """
+    client, _ = _get_dynamodb_clients(user_id=user_id)
+    return client
 
 
 def _get_table_client(user_id):
     """Get a DynamoDB table client with row-level access."""
-    return _get_aws_resource("dynamodb", user_id=user_id).Table(TABLE_NAME)
+    _, table = _get_dynamodb_clients(user_id=user_id)
+    return table
 
 
 def _get_table_public_client():
     """Get a DynamoDB table client.
     Warning: No row-level access. Use for only limited use case.
     """
-    return _get_aws_resource("dynamodb").Table(TABLE_NAME)
+    _, table = _get_dynamodb_clients()
+    return table
@@ -1,14 +1,19 @@
-import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import Decimal as decimal
 from functools import wraps
 
 import boto3
+import orjson
+import zstandard
 from app.repositories.common import (
-    TRANSACTION_BATCH_SIZE,
+    TABLE_NAME,
     RecordNotFoundError,
+    _get_dynamodb_client,
     _get_table_client,
     compose_conv_id,
     decompose_conv_id,
@@ -22,8 +27,8 @@ from app.repositories.models.conversation import (
     MessageModel,
 )
 from app.utils import get_current_time
-from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
+from pydantic import TypeAdapter, ValidationError
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -31,6 +36,127 @@ s3_client = boto3.client("s3")
 
 THRESHOLD_LARGE_MESSAGE = 300 * 1024  # 300KB
 LARGE_MESSAGE_BUCKET = os.environ.get("LARGE_MESSAGE_BUCKET")
+S3_DELETE_BATCH_SIZE = 1000
+BATCH_GET_SIZE = 100
+BATCH_GET_MAX_RETRIES = 5
+BATCH_GET_RETRY_BASE_DELAY = 0.05  # seconds
+# Leading byte of the binary `MessageMap` attribute to identify its encoding.
+# Items stored by older versions hold the message map as a plain JSON string.
+MESSAGE_MAP_FORMAT_ZSTD = b"\x01"
+ZSTD_COMPRESSION_LEVEL = 3
+
+# NOTE: zstd (de)compressor instances must not be shared across threads
+_zstd = threading.local()
+_MESSAGE_MAP_ADAPTER = TypeAdapter(dict[str, MessageModel])
+
+
+def _get_zstd_compressor() -> zstandard.ZstdCompressor:
+    if not hasattr(_zstd, "compressor"):
+        _zstd.compressor = zstandard.ZstdCompressor(level=ZSTD_COMPRESSION_LEVEL)
+    return _zstd.compressor
+
+
+def _get_zstd_decompressor() -> zstandard.ZstdDecompressor:
+    if not hasattr(_zstd, "decompressor"):
+        _zstd.decompressor = zstandard.ZstdDecompressor()
+    return _zstd.decompressor
+
+
+def _compress_message_map(message_map_json: bytes) -> bytes:
+    return MESSAGE_MAP_FORMAT_ZSTD + _get_zstd_compressor().compress(message_map_json)
+
+
+def _encode_message_map(message_map: dict[str, MessageModel]) -> bytes:
+    """Serialize the message map to zstd compressed JSON to reduce item size.
+    NOTE: `MessageMap` is intentionally not a DynamoDB Map attribute. Updating a
+    single message with `SET MessageMap.#id` would not reduce consumed write
+    capacity since it is calculated from the whole item size, while a Map is
+    larger than the compressed JSON and needs per-attribute (de)serialization.
+    """
+    return _compress_message_map(_MESSAGE_MAP_ADAPTER.dump_json(message_map))
+
+
+def _decode_message_map_json(attribute: dict) -> str | bytes:
+    """Get the JSON of `MessageMap` attribute value returned by the low-level client."""
+    if "S" in attribute:
+        # For backward compatibility
+        return attribute["S"]
+
+    data = attribute["B"]
+    if data[:1] != MESSAGE_MAP_FORMAT_ZSTD:
+        raise ValueError(f"Unsupported message map format: {data[:1]!r}")
+    return _get_zstd_decompressor().decompress(data[1:])
+
+
+def _decode_message_map(attribute: dict) -> dict[str, MessageModel]:
+    """Decode `MessageMap` attribute value returned by the low-level client."""
+    return _parse_message_map(_decode_message_map_json(attribute))
+
+
+def _parse_message_map(message_map_json: str | bytes) -> dict[str, MessageModel]:
+    try:
+        return _MESSAGE_MAP_ADAPTER.validate_json(message_map_json)
+    except ValidationError:
+        # For backward compatibility
+        return _parse_legacy_message_map(orjson.loads(message_map_json))
+
+
+def _parse_legacy_message_map(message_map: dict) -> dict[str, MessageModel]:
+    """Parse message map stored by older versions, which may lack some fields."""
+    return {
+        k: MessageModel(
+            role=v["role"],
+            content=(
+                [
+                    ContentModel(
+                        content_type=c["content_type"],
+                        body=c["body"],
+                        media_type=c["media_type"],
+                    )
+                    for c in v["content"]
+                ]
+                if type(v["content"]) == list
+                else [
+                    # For backward compatibility
+                    ContentModel(
+                        content_type=v["content"]["content_type"],
+                        body=v["content"]["body"],
+                        media_type=None,
+                    )
+                ]
+            ),
+            model=v["model"],
+            children=v["children"],
+            parent=v["parent"],
+            create_time=float(v["create_time"]),
+            feedback=(
+                FeedbackModel(
+                    thumbs_up=v["feedback"]["thumbs_up"],
+                    category=v["feedback"]["category"],
+                    comment=v["feedback"]["comment"],
+                )
+                if v.get("feedback")
+                else None
+            ),
+            used_chunks=(
+                [
+                    ChunkModel(
+                        content=c["content"],
+                        content_type=(
+                            c["content_type"] if "content_type" in c else "s3"
+                        ),
+                        source=c["source"],
+                        rank=c["rank"],
+                    )
+                    for c in v["used_chunks"]
+                ]
+                if v.get("used_chunks")
+                else None
+            ),
+            thinking_log=v.get("thinking_log"),
+        )
+        for k, v in message_map.items()
+    }
 
 
 def store_conversation(
@@ -53,14 +179,14 @@ def store_conversation(
     if conversation.bot_id:
         item_params["BotId"] = conversation.bot_id
 
-    message_map = {
-        k: {
-            **v.model_dump(),
-            "content": [c.model_dump() for c in v.content],
-        }
-        for k, v in conversation.message_map.items()
-    }
-    message_map_size = len(json.dumps(message_map).encode("utf-8"))
+    if "system" in conversation.message_map:
+        # NOTE: all message has the same model. Keep it as a top-level attribute
+        # so that listing conversations does not need to fetch `MessageMap`.
+        item_params["Model"] = conversation.message_map["system"].model
+
+    message_map_json = _MESSAGE_MAP_ADAPTER.dump_json(conversation.message_map)
+    encoded_message_map = _compress_message_map(message_map_json)
+    message_map_size = len(encoded_message_map)
     logger.info(f"Message map size: {message_map_size}")
     if message_map_size > threshold:
         logger.info(
@@ -73,21 +199,15 @@ def store_conversation(
         s3_client.put_object(
             Bucket=LARGE_MESSAGE_BUCKET,
             Key=large_message_path,
-            Body=json.dumps(message_map),
+            Body=message_map_json,
         )
         # Store only `system` attribute in DynamoDB
-        item_params["MessageMap"] = json.dumps(
-            {
-                k: v.model_dump()
-                for k, v in conversation.message_map.items()
-                if k == "system"
-            }
+        item_params["MessageMap"] = _encode_message_map(
+            {k: v for k, v in conversation.message_map.items() if k == "system"}
         )
     else:
         item_params["IsLargeMessage"] = False
-        item_params["MessageMap"] = json.dumps(
-            {k: v.model_dump() for k, v in conversation.message_map.items()}
-        )
+        item_params["MessageMap"] = encoded_message_map
 
     response = table.put_item(
         Item=item_params,
@@ -95,60 +215,131 @@ def store_conversation(
     return response
 
 
+def _backfill_models_from_message_map(client, user_id: str, sks: list[dict]) -> dict:
+    """Find the model of conversations stored by older versions, which do not
+    have `Model` attribute, from their `MessageMap` and store it as `Model` so
+    that they are not read again.
+    Returns a dict of SK to model.
+    """
+    models = {}
+    # NOTE: `batch_get_item` accepts up to 100 keys per request
+    for i in range(0, len(sks), BATCH_GET_SIZE):
+        request_items = {
+            TABLE_NAME: {
+                "Keys": [
+                    {"PK": {"S": user_id}, "SK": sk}
+                    for sk in sks[i : i + BATCH_GET_SIZE]
+                ],
+                "ProjectionExpression": "SK, MessageMap",
+            }
+        }
+        retry_count = 0
+        while request_items:
+            if retry_count > 0:
+                if retry_count > BATCH_GET_MAX_RETRIES:
+                    logger.warning(
+                        f"Gave up reading models of {len(request_items[TABLE_NAME]['Keys'])} conversations"
+                    )
+                    break
+                # Exponential backoff for unprocessed keys due to throttling
+                time.sleep(BATCH_GET_RETRY_BASE_DELAY * 2 ** (retry_count - 1))
+            response = client.batch_get_item(RequestItems=request_items)
+            for item in response["Responses"].get(TABLE_NAME, []):
+                message_map = orjson.loads(_decode_message_map_json(item["MessageMap"]))
+                # NOTE: all message has the same model
+                models[item["SK"]["S"]] = message_map.get("system", {}).get("model", "")
+            request_items = response.get("UnprocessedKeys")
+            retry_count += 1
+
+    for sk, model in models.items():
+        try:
+            client.update_item(
+                TableName=TABLE_NAME,
+                Key={"PK": {"S": user_id}, "SK": {"S": sk}},
+                UpdateExpression="SET Model = :m",
+                # NOTE: Do not recreate the item deleted in the meantime
+                ConditionExpression="attribute_exists(PK) AND attribute_not_exists(Model)",
+                ExpressionAttributeValues={":m": {"S": model}},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise e
+    return models
+
+
 def find_conversation_by_user_id(user_id: str) -> list[ConversationMeta]:
     logger.info(f"Finding conversations for user: {user_id}")
-    table = _get_table_client(user_id)
+    # NOTE: Do not serve the list from a cache such as DynamoDB Accelerator (DAX).
+    # Writes go to DynamoDB directly and do not invalidate the query cache, while
+    # the frontend refetches the list right after creating, renaming or deleting
+    # a conversation. DAX also does not evaluate `dynamodb:LeadingKeys` condition
+    # of the session policy used for row-level access.
+    # NOTE: Use the low-level client to skip deserializing every attribute
+    client = _get_dynamodb_client(user_id)
 
     query_params = {
-        "KeyConditionExpression": Key("PK").eq(user_id)
+        "TableName": TABLE_NAME,
         # NOTE: Need SK to fetch only conversations
-        & Key("SK").begins_with(f"{user_id}#CONV#"),
+        "KeyConditionExpression": "PK = :pk AND begins_with(SK, :sk_prefix)",
+        "ExpressionAttributeValues": {
+            ":pk": {"S": user_id},
+            ":sk_prefix": {"S": f"{user_id}#CONV#"},
+        },
+        # NOTE: Do not fetch `MessageMap` since it can be large
+        "ProjectionExpression": "SK, CreateTime, Title, BotId, Model",
         "ScanIndexForward": False,
     }
 
-    response = table.query(**query_params)
-    conversations = [
-        ConversationMeta(
-            id=decompose_conv_id(item["SK"]),
-            create_time=float(item["CreateTime"]),
-            title=item["Title"],
-            # NOTE: all message has the same model
-            model=json.loads(item["MessageMap"]).get("system", {}).get("model", ""),
-            bot_id=item["BotId"] if "BotId" in item else None,
-        )
-        for item in response["Items"]
-    ]
-
+    conversations: list[ConversationMeta] = []
     query_count = 1
     MAX_QUERY_COUNT = 5
-    while "LastEvaluatedKey" in response:
-        model = (
-            json.loads(response["Items"][0]["MessageMap"])
-            .get("system", {})
-            .get("model", "")
-        )
-        query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    # NOTE: Pages must be fetched in order, but the next page can be fetched
+    # while the current page is being converted.
+    with ThreadPoolExecutor(max_workers=1) as executor:
         # NOTE: max page size is 1MB
         # See: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Query.Pagination.html
-        response = table.query(
+        response = client.query(
             **query_params,
         )
-        conversations.extend(
-            [
-                ConversationMeta(
-                    id=decompose_conv_id(item["SK"]),
-                    create_time=float(item["CreateTime"]),
-                    title=item["Title"],
-                    model=model,
-                    bot_id=item["BotId"] if "BotId" in item else None,
-                )
-                for item in response["Items"]
-            ]
-        )
-        query_count += 1
-        if query_count > MAX_QUERY_COUNT:
-            logger.warning(f"Query count exceeded {MAX_QUERY_COUNT}")
-            break
+        while True:
+            next_page = None
+            # Check if next page exists
+            if "LastEvaluatedKey" in response:
+                if query_count > MAX_QUERY_COUNT:
+                    logger.warning(f"Query count exceeded {MAX_QUERY_COUNT}")
+                else:
+                    # Load next page
+                    query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+                    next_page = executor.submit(client.query, **query_params)
+                    query_count += 1
+
+            # NOTE: `Model` does not exist on items stored by older versions
+            legacy_models = _backfill_models_from_message_map(
+                client,
+                user_id,
+                [item["SK"] for item in response["Items"] if "Model" not in item],
+            )
+            conversations.extend(
+                [
+                    # NOTE: Skip validation since the item is stored by ourselves
+                    ConversationMeta.model_construct(
+                        id=decompose_conv_id(item["SK"]["S"]),
+                        create_time=float(item["CreateTime"]["N"]),
+                        title=item["Title"]["S"],
+                        model=(
+                            item["Model"]["S"]
+                            if "Model" in item
+                            else legacy_models.get(item["SK"]["S"], "")
+                        ),
+                        bot_id=item["BotId"]["S"] if "BotId" in item else None,
+                    )
+                    for item in response["Items"]
+                ]
+            )
+
+            if next_page is None:
+                break
+            response = next_page.result()
 
     logger.info(f"Found conversations: {conversations}")
     return conversations
@@ -156,86 +347,45 @@ def find_conversation_by_user_id(user_id: str) -> list[ConversationMeta]:
 
 def find_conversation_by_id(user_id: str, conversation_id: str) -> ConversationModel:
     logger.info(f"Finding conversation: {conversation_id}")
-    table = _get_table_client(user_id)
-    response = table.query(
-        IndexName="SKIndex",
-        KeyConditionExpression=Key("SK").eq(compose_conv_id(user_id, conversation_id)),
+    # NOTE: Do not cache the result in process. The conversation is written by
+    # both REST API and WebSocket handlers running on separate instances, and
+    # `store_conversation` overwrites the whole item with the message map read
+    # here, so a stale copy would drop messages, titles or feedback.
+    # NOTE: Use the low-level client to skip deserializing every attribute
+    client = _get_dynamodb_client(user_id)
+    # NOTE: Both keys are known, so get the item from the base table directly
+    # instead of querying `SKIndex`, which is only eventually consistent.
+    response = client.get_item(
+        TableName=TABLE_NAME,
+        Key={
+            "PK": {"S": user_id},
+            "SK": {"S": compose_conv_id(user_id, conversation_id)},
+        },
+        ConsistentRead=True,
     )
-    if len(response["Items"]) == 0:
+    if "Item" not in response:
         raise RecordNotFoundError(f"No conversation found with id: {conversation_id}")
 
-    # NOTE: conversation is unique
-    item = response["Items"][0]
-    if item.get("IsLargeMessage", False):
-        large_message_path = item["LargeMessagePath"]
+    item = response["Item"]
+    if "IsLargeMessage" in item and item["IsLargeMessage"]["BOOL"]:
+        large_message_path = item["LargeMessagePath"]["S"]
         response = s3_client.get_object(
             Bucket=LARGE_MESSAGE_BUCKET, Key=large_message_path
         )
-        message_map = json.loads(response["Body"].read().decode("utf-8"))
+        message_map = _parse_message_map(response["Body"].read())
     else:
-        message_map = json.loads(item["MessageMap"])
-
-    conv = ConversationModel(
-        id=decompose_conv_id(item["SK"]),
-        create_time=float(item["CreateTime"]),
-        title=item["Title"],
-        total_price=item.get("TotalPrice", 0),
-        message_map={
-            k: MessageModel(
-                role=v["role"],
-                content=(
-                    [
-                        ContentModel(
-                            content_type=c["content_type"],
-                            body=c["body"],
-                            media_type=c["media_type"],
-                        )
-                        for c in v["content"]
-                    ]
-                    if type(v["content"]) == list
-                    else [
-                        # For backward compatibility
-                        ContentModel(
-                            content_type=v["content"]["content_type"],
-                            body=v["content"]["body"],
-                            media_type=None,
-                        )
-                    ]
-                ),
-                model=v["model"],
-                children=v["children"],
-                parent=v["parent"],
-                create_time=float(v["create_time"]),
-                feedback=(
-                    FeedbackModel(
-                        thumbs_up=v["feedback"]["thumbs_up"],
-                        category=v["feedback"]["category"],
-                        comment=v["feedback"]["comment"],
-                    )
-                    if v.get("feedback")
-                    else None
-                ),
-                used_chunks=(
-                    [
-                        ChunkModel(
-                            content=c["content"],
-                            content_type=(
-                                c["content_type"] if "content_type" in c else "s3"
-                            ),
-                            source=c["source"],
-                            rank=c["rank"],
-                        )
-                        for c in v["used_chunks"]
-                    ]
-                    if v.get("used_chunks")
-                    else None
-                ),
-                thinking_log=v.get("thinking_log"),
-            )
-            for k, v in message_map.items()
-        },
-        last_message_id=item["LastMessageId"],
-        bot_id=item["BotId"] if "BotId" in item else None,
+        message_map = _decode_message_map(item["MessageMap"])
+
+    # NOTE: Skip validation since the item is stored by ourselves.
+    # `message_map` is already validated by `_MESSAGE_MAP_ADAPTER` from JSON.
+    conv = ConversationModel.model_construct(
+        id=decompose_conv_id(item["SK"]["S"]),
+        create_time=float(item["CreateTime"]["N"]),
+        title=item["Title"]["S"],
+        total_price=float(item["TotalPrice"]["N"]) if "TotalPrice" in item else 0,
+        message_map=message_map,
+        last_message_id=item["LastMessageId"]["S"],
+        bot_id=item["BotId"]["S"] if "BotId" in item else None,
     )
     logger.info(f"Found conversation: {conv}")
     return conv
@@ -254,7 +404,9 @@ def delete_conversation_by_id(user_id: str, conversation_id: str):
 
         item = response.get("Item")
         if item and item.get("IsLargeMessage", False):
-            # Delete the large message map from S3
+            # Delete the large message map from S3.
+            # NOTE: Delete it before the item so that the item keeps the reference
+            # to the S3 object if the deletion fails.
             s3_client.delete_object(
                 Bucket=LARGE_MESSAGE_BUCKET, Key=item["LargeMessagePath"]
             )
@@ -281,46 +433,62 @@ def delete_conversation_by_user_id(user_id: str):
     table = _get_table_client(user_id)
 
     query_params = {
-        "KeyConditionExpression": Key("PK").eq(user_id)
         # NOTE: Need SK to fetch only conversations
-        & Key("SK").begins_with(f"{user_id}#CONV#"),
+        "KeyConditionExpression": "PK = :pk AND begins_with(SK, :sk_prefix)",
+        "ExpressionAttributeValues": {
+            ":pk": user_id,
+            ":sk_prefix": f"{user_id}#CONV#",
+        },
         "ProjectionExpression": "SK, IsLargeMessage, LargeMessagePath",
     }
 
-    def delete_batch(batch):
-        with table.batch_writer() as writer:
-            for item in batch:
-                writer.delete_item(Key={"PK": user_id, "SK": item["SK"]})
-
-    def delete_large_messages(items):
-        for item in items:
-            if item.get("IsLargeMessage", False):
-                s3_client.delete_object(
-                    Bucket=LARGE_MESSAGE_BUCKET, Key=item["LargeMessagePath"]
-                )
+    def delete_large_messages(items) -> set[str]:
+        """Delete large message maps from S3 and return the keys failed to delete."""
+        keys = [
+            {"Key": item["LargeMessagePath"]}
+            for item in items
+            if item.get("IsLargeMessage", False)
+        ]
+        failed_keys = set()
+        # NOTE: `delete_objects` accepts up to 1000 keys per request
+        for i in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            response = s3_client.delete_objects(
+                Bucket=LARGE_MESSAGE_BUCKET,
+                Delete={"Objects": keys[i : i + S3_DELETE_BATCH_SIZE]},
+            )
+            # NOTE: `delete_objects` does not raise on failures of each key
+            for error in response.get("Errors", []):
+                logger.error(f"Failed to delete {error['Key']}: {error.get('Message')}")
+                failed_keys.add(error["Key"])
+        return failed_keys
 
     try:
         response = table.query(
             **query_params,
         )
 
-        while True:
-            items = response.get("Items", [])
-            delete_large_messages(items)
-
-            for i in range(0, len(items), TRANSACTION_BATCH_SIZE):
-                batch = items[i : i + TRANSACTION_BATCH_SIZE]
-                delete_batch(batch)
-
-            # Check if next page exists
-            if "LastEvaluatedKey" not in response:
-                break
-
-            # Load next page
-            query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
-            response = table.query(
-                **query_params,
-            )
+        # NOTE: `batch_writer` buffers deletes into `BatchWriteItem` requests of
+        # up to 25 items and resends unprocessed items automatically.
+        with table.batch_writer() as writer:
+            while True:
+                items = response.get("Items", [])
+                failed_keys = delete_large_messages(items)
+
+                for item in items:
+                    if item.get("LargeMessagePath") in failed_keys:
+                        # Keep the item to not lose track of the S3 object
+                        continue
+                    writer.delete_item(Key={"PK": user_id, "SK": item["SK"]})
+
+                # Check if next page exists
+                if "LastEvaluatedKey" not in response:
+                    break
+
+                # Load next page
+                query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+                response = table.query(
+                    **query_params,
+                )
 
     except ClientError as e:
         logger.error(f"An error occurred: {e.response['Error']['Message']}")
@@ -369,9 +537,7 @@ def update_feedback(
             "SK": compose_conv_id(user_id, conversation_id),
         },
         UpdateExpression="set MessageMap = :m",
-        ExpressionAttributeValues={
-            ":m": json.dumps({k: v.model_dump() for k, v in message_map.items()})
-        },
+        ExpressionAttributeValues={":m": _encode_message_map(message_map)},
         ConditionExpression="attribute_exists(PK) AND attribute_exists(SK)",
         ReturnValues="UPDATED_NEW",
     )
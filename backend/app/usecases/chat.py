@@ -1,4 +1,5 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from typing import Literal
 
@@ -63,6 +64,9 @@ logger.setLevel(logging.DEBUG)
 
 client = get_anthropic_client()
 
+# NOTE: Used to overlap independent DynamoDB round trips within a request.
+_executor = ThreadPoolExecutor()
+
 
 def prepare_conversation(
     user_id: str,
@@ -70,6 +74,13 @@ def prepare_conversation(
 ) -> tuple[str, ConversationModel, BotModel | None]:
     current_time = get_current_time()
     bot = None
+    # NOTE: The bot is needed whether or not the conversation exists,
+    # so fetch it while the conversation is being fetched.
+    bot_future = (
+        _executor.submit(fetch_bot, user_id, chat_input.bot_id)
+        if chat_input.bot_id
+        else None
+    )
 
     try:
         # Fetch existing conversation
@@ -82,8 +93,9 @@ def prepare_conversation(
         elif chat_input.message.parent_message_id is None:
             parent_id = conversation.last_message_id
         if chat_input.bot_id:
-            logger.info("Bot id is provided. Fetching bot.")
-            owned, bot = fetch_bot(user_id, chat_input.bot_id)
+            logger.info("Bot id is provided. Waiting for the bot to be fetched.")
+            assert bot_future is not None
+            owned, bot = bot_future.result()
     except RecordNotFoundError:
         # The case for new conversation. Note that editing first user message is not considered as new conversation.
         logger.info(
@@ -112,10 +124,11 @@ def prepare_conversation(
         }
         parent_id = "system"
         if chat_input.bot_id:
-            logger.info("Bot id is provided. Fetching bot.")
+            logger.info("Bot id is provided. Waiting for the bot to be fetched.")
             parent_id = "instruction"
-            # Fetch bot and append instruction
-            owned, bot = fetch_bot(user_id, chat_input.bot_id)
+            # Wait for the bot and append instruction
+            assert bot_future is not None
+            owned, bot = bot_future.result()
             initial_message_map["instruction"] = MessageModel(
                 role="instruction",
                 content=[
@@ -1,7 +1,7 @@
 import json
 import logging
 import os
-from datetime import datetime
+import time
 from typing import Any, List, Literal
 
 import boto3
@@ -42,7 +42,7 @@ def get_anthropic_client(region=BEDROCK_REGION):
 
 def get_current_time():
     # Get current time as milliseconds epoch time
-    return int(datetime.now().timestamp() * 1000)
+    return int(time.time() * 1000)
 
 
 def generate_presigned_url(
@@ -0,0 +1,77 @@
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+sys.path.append(".")
+
+from app.repositories import common
+from app.repositories.common import SESSION_EXPIRY_MARGIN, _get_dynamodb_clients
+
+
+class _StubStsClient:
+    def __init__(self, expires_in: timedelta):
+        self.expires_in = expires_in
+        self.assumed_policies: list[str] = []
+
+    def assume_role(self, RoleArn, RoleSessionName, Policy):
+        self.assumed_policies.append(Policy)
+        return {
+            "Credentials": {
+                "AccessKeyId": "key",
+                "SecretAccessKey": "secret",
+                "SessionToken": "token",
+                "Expiration": datetime.now(timezone.utc) + self.expires_in,
+            }
+        }
+
+
+class TestDynamoDBClientsCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.sts_client = _StubStsClient(expires_in=timedelta(hours=1))
+        patchers = [
+            patch.dict(os.environ, {"AWS_EXECUTION_ENV": "AWS_Lambda_python3.11"}),
+            patch.object(common, "_get_sts_client", lambda: self.sts_client),
+            patch.object(common, "_clients_cache", {}),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_reuse_clients_before_expiration(self):
+        client, table = _get_dynamodb_clients("user1")
+        cached_client, cached_table = _get_dynamodb_clients("user1")
+        self.assertIs(cached_client, client)
+        self.assertIs(cached_table, table)
+        self.assertEqual(len(self.sts_client.assumed_policies), 1)
+
+    def test_assume_role_again_near_expiration(self):
+        # Credentials expire within the margin
+        self.sts_client.expires_in = SESSION_EXPIRY_MARGIN - timedelta(seconds=1)
+        client, _ = _get_dynamodb_clients("user1")
+        self.assertIsNot(_get_dynamodb_clients("user1")[0], client)
+        self.assertEqual(len(self.sts_client.assumed_policies), 2)
+
+    def test_evict_oldest_clients(self):
+        with patch.object(common, "SESSION_CACHE_MAX_SIZE", 2):
+            client1, _ = _get_dynamodb_clients("user1")
+            client2, _ = _get_dynamodb_clients("user2")
+            _get_dynamodb_clients("user3")
+            self.assertNotIn("user1", common._clients_cache)
+            self.assertIs(_get_dynamodb_clients("user2")[0], client2)
+            self.assertIsNot(_get_dynamodb_clients("user1")[0], client1)
+        self.assertEqual(len(self.sts_client.assumed_policies), 4)
+
+    def test_clients_are_not_shared_with_public_access(self):
+        user_client, _ = _get_dynamodb_clients("user1")
+        public_client, _ = _get_dynamodb_clients()
+        self.assertIsNot(user_client, public_client)
+        self.assertIs(_get_dynamodb_clients()[0], public_client)
+        # Only the clients for the user are restricted to the user's items
+        self.assertIn("LeadingKeys", self.sts_client.assumed_policies[0])
+        self.assertNotIn("LeadingKeys", self.sts_client.assumed_policies[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,16 @@
+import base64
+import json
+import os
 import sys
 import unittest
+from decimal import Decimal as decimal
 
 sys.path.append(".")
 
 from app.config import DEFAULT_EMBEDDING_CONFIG
+from app.repositories.common import _get_table_client, compose_conv_id
 from app.repositories.conversation import (
+    MESSAGE_MAP_FORMAT_ZSTD,
     ContentModel,
     ConversationModel,
     MessageModel,
@@ -16,6 +22,8 @@ from app.repositories.conversation import (
     find_conversation_by_user_id,
     store_conversation,
     update_feedback,
+    _decode_message_map,
+    _encode_message_map,
 )
 from app.repositories.custom_bot import (
     delete_bot_by_id,
@@ -303,6 +311,175 @@ class TestConversationRepository(unittest.TestCase):
         conversations = find_conversation_by_user_id(user_id="user")
         self.assertEqual(len(conversations), 0)
 
+    def test_delete_many_conversations(self):
+        def create_conversation(id: str, body: str) -> ConversationModel:
+            return ConversationModel(
+                id=id,
+                create_time=1627984879.9,
+                title="Test Conversation",
+                total_price=0,
+                message_map={
+                    "a": MessageModel(
+                        role="user",
+                        content=[
+                            ContentModel(
+                                content_type="text", body=body, media_type=None
+                            )
+                        ],
+                        model="claude-instant-v1",
+                        children=[],
+                        parent=None,
+                        create_time=1627984879.9,
+                        feedback=None,
+                        used_chunks=None,
+                        thinking_log=None,
+                    )
+                },
+                last_message_id="a",
+                bot_id=None,
+            )
+
+        # More items than a single `BatchWriteItem` request accepts
+        for i in range(30):
+            store_conversation("user", create_conversation(f"small_{i}", "Hello"))
+        # Hardly compressible message maps to exceed 1MB of query page size
+        for i in range(6):
+            body = base64.b64encode(os.urandom(200 * 1024)).decode()
+            store_conversation("user", create_conversation(f"medium_{i}", body))
+        # Message maps stored in S3
+        for i in range(2):
+            store_conversation(
+                "user", create_conversation(f"large_{i}", "Hello"), threshold=1
+            )
+        self.assertEqual(len(find_conversation_by_user_id(user_id="user")), 38)
+
+        delete_conversation_by_user_id(user_id="user")
+        conversations = find_conversation_by_user_id(user_id="user")
+        self.assertEqual(len(conversations), 0)
+
+    def test_find_legacy_conversation(self):
+        # Conversations stored by older versions have `MessageMap` as a JSON string
+        table = _get_table_client("user")
+        table.put_item(
+            Item={
+                "PK": "user",
+                "SK": compose_conv_id("user", "3"),
+                "Title": "Legacy Conversation",
+                "CreateTime": decimal("1627984879.9"),
+                "TotalPrice": decimal("100"),
+                "LastMessageId": "a",
+                "IsLargeMessage": False,
+                "MessageMap": json.dumps(
+                    {
+                        "system": {
+                            "role": "system",
+                            "content": {"content_type": "text", "body": ""},
+                            "model": "claude-instant-v1",
+                            "children": ["a"],
+                            "parent": None,
+                            "create_time": 1627984879.9,
+                        },
+                        "a": {
+                            "role": "user",
+                            "content": {"content_type": "text", "body": "Hello"},
+                            "model": "claude-instant-v1",
+                            "children": [],
+                            "parent": None,
+                            "create_time": 1627984879.9,
+                        },
+                    }
+                ),
+            }
+        )
+
+        found_conversation = find_conversation_by_id(
+            user_id="user", conversation_id="3"
+        )
+        self.assertEqual(found_conversation.title, "Legacy Conversation")
+        message = found_conversation.message_map["a"]
+        self.assertEqual(message.content[0].body, "Hello")
+        self.assertEqual(message.content[0].media_type, None)
+        self.assertEqual(message.model, "claude-instant-v1")
+
+        # `Model` attribute does not exist, so the model is read from `MessageMap`
+        conversations = find_conversation_by_user_id(user_id="user")
+        self.assertEqual(len(conversations), 1)
+        self.assertEqual(conversations[0].model, "claude-instant-v1")
+
+        # The model is stored so that `MessageMap` is not read again
+        item = table.get_item(Key={"PK": "user", "SK": compose_conv_id("user", "3")})[
+            "Item"
+        ]
+        self.assertEqual(item["Model"], "claude-instant-v1")
+        conversations = find_conversation_by_user_id(user_id="user")
+        self.assertEqual(conversations[0].model, "claude-instant-v1")
+
+        delete_conversation_by_user_id(user_id="user")
+
+    def test_find_conversation_model(self):
+        conversation = ConversationModel(
+            id="4",
+            create_time=1627984879.9,
+            title="Test Conversation",
+            total_price=0,
+            message_map={
+                "system": MessageModel(
+                    role="system",
+                    content=[
+                        ContentModel(content_type="text", body="", media_type=None)
+                    ],
+                    model="claude-v3-haiku",
+                    children=[],
+                    parent=None,
+                    create_time=1627984879.9,
+                    feedback=None,
+                    used_chunks=None,
+                    thinking_log=None,
+                )
+            },
+            last_message_id="",
+            bot_id=None,
+        )
+        store_conversation("user", conversation)
+
+        # The model is kept as a top-level attribute
+        item = _get_table_client("user").get_item(
+            Key={"PK": "user", "SK": compose_conv_id("user", "4")}
+        )["Item"]
+        self.assertEqual(item["Model"], "claude-v3-haiku")
+
+        conversations = find_conversation_by_user_id(user_id="user")
+        self.assertEqual(len(conversations), 1)
+        self.assertEqual(conversations[0].model, "claude-v3-haiku")
+
+        delete_conversation_by_user_id(user_id="user")
+
+
+class TestMessageMapEncoding(unittest.TestCase):
+    def test_decode_encoded_message_map(self):
+        message_map = {
+            "a": MessageModel(
+                role="user",
+                content=[
+                    ContentModel(content_type="text", body="Hello", media_type=None)
+                ],
+                model="claude-instant-v1",
+                children=[],
+                parent=None,
+                create_time=1627984879.9,
+                feedback=None,
+                used_chunks=None,
+                thinking_log=None,
+            )
+        }
+        encoded = _encode_message_map(message_map)
+        self.assertEqual(encoded[:1], MESSAGE_MAP_FORMAT_ZSTD)
+        self.assertEqual(_decode_message_map({"B": encoded}), message_map)
+
+    def test_decode_unknown_format(self):
+        with self.assertRaises(ValueError):
+            _decode_message_map({"B": b"\xff" + b"{}"})
+
 
 class TestConversationBotRepository(unittest.TestCase):
     def setUp(self) -> None:
@@ -581,6 +581,38 @@ class TestChatWithCustomizedBot(unittest.TestCase):
         delete_bot_by_id(self.second_user_id, self.first_public_bot_id)
         delete_conversation_by_user_id(self.first_user_id)
 
+    def test_prepare_conversation_with_bot(self):
+        chat_input = ChatInput(
+            conversation_id="test_conversation_id",
+            message=MessageInput(
+                role="user",
+                content=[
+                    Content(
+                        content_type="text",
+                        body="こんにちは",
+                        media_type=None,
+                    )
+                ],
+                model=MODEL,
+                parent_message_id=None,
+                message_id=None,
+            ),
+            bot_id="private1",
+        )
+        # New conversation
+        user_msg_id, conversation, bot = prepare_conversation("user1", chat_input)
+        self.assertIsNotNone(bot)
+        self.assertEqual(bot.id, "private1")  # type: ignore
+        self.assertEqual(conversation.message_map[user_msg_id].parent, "instruction")
+        store_conversation("user1", conversation)
+
+        # Existing conversation
+        chat_input.message.parent_message_id = user_msg_id
+        user_msg_id, conversation, bot = prepare_conversation("user1", chat_input)
+        self.assertIsNotNone(bot)
+        self.assertEqual(bot.id, "private1")  # type: ignore
+        self.assertIn("instruction", conversation.message_map)
+
     def test_chat_with_private_bot(self):
         # First message
         chat_input = ChatInput(
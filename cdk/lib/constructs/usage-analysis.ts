@@ -83,7 +83,11 @@ export class UsageAnalysis extends Construct {
       },
       {
         name: "MessageMap",
-        type: glue.Schema.struct([{ name: "S", type: glue.Schema.STRING }]),
+        type: glue.Schema.struct([
+          { name: "S", type: glue.Schema.STRING },
+          // zstd compressed binary, base64 encoded in the export
+          { name: "B", type: glue.Schema.STRING },
+        ]),
       },
       {
         name: "IsLargeMessage",